@@ -12,7 +12,9 @@ from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 import yaml
 from utils.paths import get_project
+from utils.staging import StagingManager, TMPFS_ROOT, DEFAULT_BUDGET_BYTES, DEFAULT_TMPFS_HEADROOM_BYTES
 import os
+import threading
 
 with open(get_project("O2O") / "config.yaml", 'r') as f:
     config = yaml.safe_load(f)
@@ -29,6 +31,8 @@ class MediaDataHandler:
 
         self.conn = sqlite3.connect(self.project_path / "data.db", check_same_thread=False)
         self.cur = self.conn.cursor()
+        # The connection and cursor are shared, so each statement and its fetch must run under this lock.
+        self.lock = threading.RLock()
 
         self.cur.executescript("""
             CREATE TABLE IF NOT EXISTS playlists (
@@ -67,12 +71,13 @@ class MediaDataHandler:
         if table not in allowed_tables:
             raise ValueError(f"Invalid table: {table}")
 
-        query = f"SELECT * FROM {table} WHERE {column} LIKE ?"
-        self.cur.execute(query, (f"%{value}%",))
-        rows = self.cur.fetchall()
+        with self.lock:
+            query = f"SELECT * FROM {table} WHERE {column} LIKE ?"
+            self.cur.execute(query, (f"%{value}%",))
+            rows = self.cur.fetchall()
 
-        columns = [desc[0] for desc in self.cur.description]
-        return [dict(zip(columns, row)) for row in rows]
+            columns = [desc[0] for desc in self.cur.description]
+            return [dict(zip(columns, row)) for row in rows]
 
     def search_all(self, value):
         tables = {"playlists", "playlist_media"}
@@ -100,21 +105,22 @@ class MediaDataHandler:
         dest = self.data / file_name
         shutil.copy2(filepath, dest)
 
-        self.cur.execute("""
-            INSERT INTO playlist_media (
-                row_id, file_name, title, author, playlist_id, other_metadata
-            ) VALUES (?, ?, ?, ?, ?, ?)
-        """, (
-            row_id,
-            file_name,
-            title,
-            author,
-            self.search("playlists", "title", "All Media")[0]["id"],
-            json.dumps(other_metadata)
-        ))
-
-        self.conn.commit()
-        return row_id
+        with self.lock:
+            self.cur.execute("""
+                INSERT INTO playlist_media (
+                    row_id, file_name, title, author, playlist_id, other_metadata
+                ) VALUES (?, ?, ?, ?, ?, ?)
+            """, (
+                row_id,
+                file_name,
+                title,
+                author,
+                self.search("playlists", "title", "All Media")[0]["id"],
+                json.dumps(other_metadata)
+            ))
+
+            self.conn.commit()
+            return row_id
 
     def move_upload_media(self, filepath, title='', author='', other_metadata=None):
         row_id = self.upload_media(filepath, title=title, author=author, other_metadata=other_metadata)
@@ -122,23 +128,24 @@ class MediaDataHandler:
         return row_id
 
     def add_media_to_playlist(self, playlist_id, row_id):
-        data = self.search("playlist_media", "row_id", row_id)[0]
-        new_row_id = str(uuid4())
-
-        self.cur.execute("""
-            INSERT INTO playlist_media (
-                row_id, file_name, title, author, playlist_id, other_metadata
-            ) VALUES (?, ?, ?, ?, ?, ?)
-        """, (
-            new_row_id,
-            data['file_name'],
-            data['title'],
-            data['author'],
-            playlist_id,
-            data['other_metadata']
-        ))
-        self.conn.commit()
-        return new_row_id
+        with self.lock:
+            data = self.search("playlist_media", "row_id", row_id)[0]
+            new_row_id = str(uuid4())
+
+            self.cur.execute("""
+                INSERT INTO playlist_media (
+                    row_id, file_name, title, author, playlist_id, other_metadata
+                ) VALUES (?, ?, ?, ?, ?, ?)
+            """, (
+                new_row_id,
+                data['file_name'],
+                data['title'],
+                data['author'],
+                playlist_id,
+                data['other_metadata']
+            ))
+            self.conn.commit()
+            return new_row_id
 
     def create_playlist(self, title="Untitled Playlist", thumbnail_file_name="defaultPlaylistThumbnail.jpg"):
         id = str(uuid4())
@@ -149,30 +156,41 @@ class MediaDataHandler:
                 return get_unique_title(title)
             return title
 
-        self.cur.execute("""
-            INSERT INTO playlists (id, title, thumbnail_file_name)
-            VALUES (?, ?, ?)
-        """, (id, get_unique_title(title), thumbnail_file_name))
-        self.conn.commit()
-        return id
+        with self.lock:
+            self.cur.execute("""
+                INSERT INTO playlists (id, title, thumbnail_file_name)
+                VALUES (?, ?, ?)
+            """, (id, get_unique_title(title), thumbnail_file_name))
+            self.conn.commit()
+            return id
 
     def get_all_media(self):
-        self.cur.execute("SELECT * FROM playlist_media")
-        rows = self.cur.fetchall()
-        columns = [desc[0] for desc in self.cur.description]
-        return [dict(zip(columns, row)) for row in rows]
+        with self.lock:
+            self.cur.execute("SELECT * FROM playlist_media")
+            rows = self.cur.fetchall()
+            columns = [desc[0] for desc in self.cur.description]
+            return [dict(zip(columns, row)) for row in rows]
 
     def get_all_playlists(self):
-        self.cur.execute("SELECT * FROM playlists")
-        rows = self.cur.fetchall()
-        columns = [desc[0] for desc in self.cur.description]
-        return [dict(zip(columns, row)) for row in rows]
+        with self.lock:
+            self.cur.execute("SELECT * FROM playlists")
+            rows = self.cur.fetchall()
+            columns = [desc[0] for desc in self.cur.description]
+            return [dict(zip(columns, row)) for row in rows]
 
     # --- Added missing methods ---
     def list_matching_pairs(self, column, value):
         """Returns matching media rows by a specific column."""
         return self.search("playlist_media", column, value)
 
+    def find_media_by_link(self, link):
+        """Returns media rows whose metadata has exactly this link."""
+        with self.lock:
+            self.cur.execute("SELECT * FROM playlist_media WHERE json_extract(other_metadata, '$.link') = ?", (link,))
+            rows = self.cur.fetchall()
+            columns = [desc[0] for desc in self.cur.description]
+            return [dict(zip(columns, row)) for row in rows]
+
     def move_file(self, result):
         """Move downloaded file into data storage."""
         filepath = Path(result['filepath'])
@@ -181,42 +199,75 @@ class MediaDataHandler:
 
 # -----------------------
 class QueryTool:
-    def __init__(self, data_handler, temp_dir=None):
+    def __init__(self, data_handler, temp_dir=None, staging_budget_bytes=None):
         self.data_handler = data_handler
+        staging_config = config.get('staging') or {}
         os_name = platform.system()
-        if os_name == "Linux":
-            self.media_folder = Path(f"/dev/shm/{uuid4()}")
-        else:
-            if temp_dir:
-                self.media_folder = Path(temp_dir) / str(uuid4())
-            else:
-                raise ValueError("Non-Linux OS detected. You must provide a temp_dir for media downloads.")
-        self.media_folder.mkdir(parents=True, exist_ok=True)
+        if os_name != "Linux" and not temp_dir:
+            raise ValueError("Non-Linux OS detected. You must provide a temp_dir for media downloads.")
+        self.staging = StagingManager(
+            budget_bytes=staging_budget_bytes or staging_config.get('budget_bytes', DEFAULT_BUDGET_BYTES),
+            tmpfs_root=TMPFS_ROOT if os_name == "Linux" else None,
+            disk_root=temp_dir,
+            tmpfs_headroom_bytes=staging_config.get('tmpfs_headroom_bytes', DEFAULT_TMPFS_HEADROOM_BYTES)
+        )
+        self.download_estimate_bytes = staging_config.get('download_estimate_bytes', 64 * 1024 ** 2)
+        self.staging_bytes_per_second = staging_config.get('bytes_per_second', 64 * 1024)
+        self._in_flight_links = set()
+        self._in_flight_lock = threading.Lock()
+
+    def estimate_download_bytes(self, result):
+        """
+        Bytes to reserve for `result` before it is downloaded.
+        Sized from its duration when known, so the budget covers the mp3 and the stream yt-dlp keeps.
+        """
+        duration_seconds = result.get("duration_seconds")
+        if duration_seconds:
+            return int(duration_seconds * self.staging_bytes_per_second)
+        return self.download_estimate_bytes
 
     def download_result(self, result, skip_existing_result=True):
+        """
+        Downloads `result` into storage and returns its row_id, or None when it was skipped.
+        """
         skip_existing_result = result.get('skip_existing_result', skip_existing_result)
-        existing = self.data_handler.list_matching_pairs("other_metadata", json.dumps({"link": result.get("link")}))
-
-        if existing and skip_existing_result:
-            print(f"Skipping result (already exists): {result['link']}")
-            return
-
-        if result["platform"] == "youtube":
-            filepath = download_youtube(result["link"], self.media_folder, uuid4())
-        else:
-            filepath = download_soundcloud(result["link"], self.media_folder, uuid4())
-
-        result["filepath"] = str(filepath)
-        result["date_extracted"] = date.today().isoformat()
-
-        self.data_handler.move_upload_media(
-            filepath,
-            title=result.get("title", ""),
-            author=result.get("artist", ""),
-            other_metadata=result
-        )
-
-        print(f"Downloaded: {result['title']}")
+        link = result.get("link")
+
+        # Checking and claiming the link together keeps concurrent callers from downloading the same link twice.
+        with self._in_flight_lock:
+            if skip_existing_result:
+                if link in self._in_flight_links:
+                    print(f"Skipping result (already downloading): {link}")
+                    return
+                if self.data_handler.find_media_by_link(link):
+                    print(f"Skipping result (already exists): {link}")
+                    return
+            self._in_flight_links.add(link)
+
+        try:
+            # The slot folder also holds the original stream kept by yt-dlp; it is removed on release.
+            with self.staging.reserve(self.estimate_download_bytes(result)) as slot:
+                if result["platform"] == "youtube":
+                    filepath = download_youtube(link, slot.folder, uuid4())
+                else:
+                    filepath = download_soundcloud(link, slot.folder, uuid4())
+                self.staging.settle(slot)
+
+                result["filepath"] = str(filepath)
+                result["date_extracted"] = date.today().isoformat()
+
+                row_id = self.data_handler.move_upload_media(
+                    filepath,
+                    title=result.get("title", ""),
+                    author=result.get("artist", ""),
+                    other_metadata=result
+                )
+        finally:
+            with self._in_flight_lock:
+                self._in_flight_links.discard(link)
+
+        print(f"Downloaded: {result.get('title', link)}")
+        return row_id
 
     def download_results(self, results, skip_existing_results=True):
         for result in results:
@@ -238,15 +289,15 @@ class QueryTool:
 
     def query_artist(self, artist_name, st_model, manual_review=True, max_results=400,
                      minimum_duration_seconds=60, maximum_duration_seconds=390,
-                     filtered_substrings=["beat", "slowed", "reverb", "free"]):
+                     filtered_substrings=["beat", "slowed", "reverb", "free"], filter_stats=None):
         if manual_review:
-            results = self.review_results(query_artist(self, artist_name, st_model, max_results,
+            results = self.review_results(query_artist(artist_name, st_model, max_results,
                                                        minimum_duration_seconds, maximum_duration_seconds,
-                                                       filtered_substrings))
+                                                       filtered_substrings, filter_stats))
         else:
-            results = query_artist(self, artist_name, st_model, max_results,
+            results = query_artist(artist_name, st_model, max_results,
                                    minimum_duration_seconds, maximum_duration_seconds,
-                                   filtered_substrings)
+                                   filtered_substrings, filter_stats)
         return results
 
 
@@ -0,0 +1,376 @@
+import argparse
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from uuid import uuid4
+from sentence_transformers import SentenceTransformer
+from app import MediaDataHandler, QueryTool, config
+from query_sources import format_filter_stats, get_soundcloud_client_id
+
+daemon_config = config.get('daemon') or {}
+DEFAULT_HOST = daemon_config.get('host', "127.0.0.1")
+DEFAULT_PORT = daemon_config.get('port', 8765)
+DEFAULT_WORKERS = daemon_config.get('workers', 4)
+DEFAULT_MAX_FINISHED_JOBS = daemon_config.get('max_finished_jobs', 200)
+
+JOB_TYPES = {"query", "download"}
+QUERY_OPTIONS = {"max_results", "minimum_duration_seconds", "maximum_duration_seconds", "filtered_substrings"}
+
+
+class SharedModel:
+    """
+    Serializes calls into one SentenceTransformer shared by every job.
+    """
+    def __init__(self, model):
+        self.model = model
+        self.lock = threading.Lock()
+
+    def encode(self, *args, **kwargs):
+        with self.lock:
+            return self.model.encode(*args, **kwargs)
+
+
+class Job:
+    def __init__(self, job_type, params):
+        self.id = str(uuid4())
+        self.type = job_type
+        self.params = params
+        self.status = "queued"
+        self.result = None
+        self.error = None
+        self.fetched = False
+        self.events = []
+        self.cond = threading.Condition()
+        self.add_event("queued")
+
+    @property
+    def finished(self):
+        return self.status in ("done", "failed", "cancelled")
+
+    def add_event(self, message, status=None):
+        with self.cond:
+            if status:
+                self.status = status
+            self.events.append({"job": self.id, "status": self.status, "message": message, "time": time.time()})
+            self.cond.notify_all()
+
+    def iter_events(self):
+        """Yields every event of the job, blocking for new ones until it finishes."""
+        index = 0
+        while True:
+            with self.cond:
+                while index >= len(self.events) and not self.finished:
+                    self.cond.wait()
+                events = self.events[index:]
+                index = len(self.events)
+                finished = self.finished
+            yield from events
+            if finished and index >= len(self.events):
+                return
+
+    def to_dict(self):
+        with self.cond:
+            return {
+                "id": self.id,
+                "type": self.type,
+                "params": self.params,
+                "status": self.status,
+                "result": self.result,
+                "error": self.error
+            }
+
+
+class O2ODaemon:
+    """
+    Keeps the sentence model, API clients and one MediaDataHandler warm,
+    and runs query/download jobs concurrently on a thread pool.
+    """
+    def __init__(self, project_path, temp_dir=None, workers=DEFAULT_WORKERS, max_finished_jobs=DEFAULT_MAX_FINISHED_JOBS):
+        self.data_handler = MediaDataHandler(project_path)
+        self.query_tool = QueryTool(self.data_handler, temp_dir)
+        self.st_model = SharedModel(SentenceTransformer("all-MiniLM-L6-v2"))
+        get_soundcloud_client_id()
+
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="o2o-job")
+        self.jobs = {}
+        self.max_finished_jobs = max_finished_jobs
+        self.lock = threading.Lock()
+        self.cancel = threading.Event()
+
+    def submit(self, job_type, params):
+        if self.cancel.is_set():
+            raise ValueError("The daemon is shutting down.")
+        if not isinstance(job_type, str) or job_type not in JOB_TYPES:
+            raise ValueError(f"Invalid job type: {job_type}")
+        if not params.get("artist") and not (job_type == "download" and params.get("results")):
+            raise ValueError("An 'artist' is required, or 'results' for a download job.")
+        if "artist" in params and not isinstance(params["artist"], str):
+            raise ValueError("'artist' must be a string.")
+        if "results" in params:
+            results = params["results"]
+            if job_type != "download" or not isinstance(results, list):
+                raise ValueError("'results' must be a list, and only for a download job.")
+            for result in results:
+                if not isinstance(result, dict) or not isinstance(result.get("link"), str) \
+                        or result.get("platform") not in ("youtube", "soundcloud"):
+                    raise ValueError("Each result must be an object with a 'link' and a 'platform' of youtube or soundcloud.")
+        unknown = set(params) - QUERY_OPTIONS - {"artist", "results", "skip_existing_results"}
+        if unknown:
+            raise ValueError(f"Invalid job parameters: {', '.join(sorted(unknown))}")
+
+        job = Job(job_type, params)
+        with self.lock:
+            self.jobs[job.id] = job
+            self.evict_finished()
+        self.executor.submit(self.run, job)
+        return job
+
+    def evict_finished(self):
+        """
+        Drops the oldest finished jobs beyond `max_finished_jobs`, evicting jobs whose result
+        was already fetched before unread ones. Must be called with `self.lock` held.
+        """
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished]
+        finished.sort(key=lambda job_id: not self.jobs[job_id].fetched)
+        for job_id in finished[:max(len(finished) - self.max_finished_jobs, 0)]:
+            del self.jobs[job_id]
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def status(self):
+        with self.lock:
+            jobs = list(self.jobs.values())
+        counts = {}
+        for job in jobs:
+            counts[job.status] = counts.get(job.status, 0) + 1
+        return {"jobs": counts, "staging": self.query_tool.staging.usage()}
+
+    def run(self, job):
+        try:
+            self.run_job(job)
+        finally:
+            with self.lock:
+                self.evict_finished()
+
+    def run_job(self, job):
+        if self.cancel.is_set():
+            job.add_event("cancelled", status="cancelled")
+            return
+        job.add_event("started", status="running")
+        try:
+            results = job.params.get("results")
+            filter_stats = {}
+            if results is None:
+                options = {k: v for k, v in job.params.items() if k in QUERY_OPTIONS}
+                results = self.query_tool.query_artist(job.params["artist"], self.st_model, manual_review=False,
+                                                       filter_stats=filter_stats, **options)
+                job.add_event(f"Found {len(results)} results for {job.params['artist']}: {format_filter_stats(filter_stats)}")
+
+            job.result = {"results": results, "items": [], "filter_stats": filter_stats}
+
+            if job.type == "download":
+                skip_existing_results = job.params.get("skip_existing_results", True)
+                for i, result in enumerate(results, 1):
+                    if self.cancel.is_set():
+                        job.add_event(f"Cancelled after {i - 1}/{len(results)} results", status="cancelled")
+                        return
+                    item = {"link": result.get("link"), "title": result.get("title")}
+                    # One bad result (a removed video, a yt-dlp error) must not drop the rest of the artist.
+                    try:
+                        row_id = self.query_tool.download_result(result, skip_existing_results)
+                        item["status"] = "downloaded" if row_id else "skipped"
+                    except Exception as e:
+                        item["status"] = "failed"
+                        item["error"] = str(e)
+                    job.result["items"].append(item)
+                    message = f"[{i}/{len(results)}] {item['status']}: {result.get('title')}"
+                    job.add_event(f"{message} ({item['error']})" if "error" in item else message)
+
+            failed = sum(item["status"] == "failed" for item in job.result["items"])
+            job.add_event(f"finished with {failed} failed results" if failed else "finished", status="done")
+        except Exception as e:
+            job.error = str(e)
+            job.add_event(f"Error: {e}", status="failed")
+
+    def shutdown(self):
+        """
+        Stops running jobs at their next result and waits for the workers,
+        so staging is only cleaned up once nothing is writing into it.
+        """
+        self.cancel.set()
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        # Jobs dropped by cancel_futures never ran, so finish them here for anyone streaming their events.
+        with self.lock:
+            jobs = list(self.jobs.values())
+        for job in jobs:
+            if not job.finished:
+                job.add_event("cancelled", status="cancelled")
+        self.query_tool.staging.cleanup()
+
+
+def make_handler(daemon):
+    class Handler(BaseHTTPRequestHandler):
+        def send_json(self, code, body):
+            data = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def host_allowed(self):
+            """
+            Only accepts a Host header naming the bound address, so pages using DNS rebinding
+            cannot reach the daemon through the browser.
+            """
+            host, port = self.server.server_address[:2]
+            allowed = {f"[{host}]:{port}" if ":" in host else f"{host}:{port}"}
+            if host in ("127.0.0.1", "::1"):
+                allowed.add(f"localhost:{port}")
+            if self.headers.get("Host") in allowed:
+                return True
+            self.send_json(403, {"error": "Invalid Host header."})
+            return False
+
+        def do_GET(self):
+            if not self.host_allowed():
+                return
+            parts = [p for p in self.path.split("?")[0].split("/") if p]
+            if parts == ["status"]:
+                return self.send_json(200, daemon.status())
+            if parts == ["jobs"]:
+                with daemon.lock:
+                    jobs = list(daemon.jobs.values())
+                return self.send_json(200, [{"id": j.id, "type": j.type, "status": j.status} for j in jobs])
+            if len(parts) in (2, 3) and parts[0] == "jobs":
+                job = daemon.get(parts[1])
+                if not job:
+                    return self.send_json(404, {"error": f"Unknown job: {parts[1]}"})
+                if len(parts) == 2:
+                    body = job.to_dict()
+                    if job.finished:
+                        job.fetched = True
+                    return self.send_json(200, body)
+                if parts[2] == "events":
+                    # Newline-delimited JSON, one event per line, until the job finishes.
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/x-ndjson")
+                    self.end_headers()
+                    try:
+                        for event in job.iter_events():
+                            self.wfile.write((json.dumps(event) + "\n").encode())
+                            self.wfile.flush()
+                    except (BrokenPipeError, ConnectionResetError):
+                        pass
+                    return
+            self.send_json(404, {"error": f"Unknown path: {self.path}"})
+
+        def do_POST(self):
+            if not self.host_allowed():
+                return
+            if self.path.rstrip("/") != "/jobs":
+                return self.send_json(404, {"error": f"Unknown path: {self.path}"})
+            # Browsers can only send JSON cross-origin after a preflight, which this server never answers.
+            if self.headers.get_content_type() != "application/json":
+                return self.send_json(400, {"error": "Content-Type must be application/json."})
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                if not isinstance(body, dict):
+                    raise ValueError("The request body must be a JSON object.")
+                job_type = body.pop("type", "query")
+                job = daemon.submit(job_type, body)
+            except ValueError as e:
+                return self.send_json(400, {"error": str(e)})
+            self.send_json(202, {"id": job.id, "status": job.status})
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(project_path, temp_dir=None, host=DEFAULT_HOST, port=DEFAULT_PORT, workers=DEFAULT_WORKERS,
+          max_finished_jobs=DEFAULT_MAX_FINISHED_JOBS):
+    daemon = O2ODaemon(project_path, temp_dir, workers, max_finished_jobs)
+    server = ThreadingHTTPServer((host, port), make_handler(daemon))
+    server.daemon_threads = True
+    print(f"O2O daemon listening on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        daemon.shutdown()
+
+
+def submit(artists, job_type="query", host=DEFAULT_HOST, port=DEFAULT_PORT, options=None, window=16):
+    """
+    Submits one job per artist to a running daemon and prints its events as they stream back.
+    At most `window` jobs are left unread at once, so results are fetched before the daemon can evict them.
+    Returns the finished jobs.
+    """
+    base_url = f"http://{host}:{port}"
+
+    def collect(job_id):
+        with urllib.request.urlopen(f"{base_url}/jobs/{job_id}/events") as response:
+            for line in response:
+                event = json.loads(line)
+                print(f"{event['job'][:8]} {event['status']}: {event['message']}")
+        with urllib.request.urlopen(f"{base_url}/jobs/{job_id}") as response:
+            return json.load(response)
+
+    jobs = []
+    pending = deque()
+    for artist in artists:
+        body = json.dumps({"type": job_type, "artist": artist, **(options or {})}).encode()
+        request = urllib.request.Request(f"{base_url}/jobs", data=body, headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request) as response:
+            pending.append(json.load(response)["id"])
+        if len(pending) >= window:
+            jobs.append(collect(pending.popleft()))
+
+    while pending:
+        jobs.append(collect(pending.popleft()))
+    return jobs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run O2O as a resident service, or send jobs to one.")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = commands.add_parser("serve", help="Start the daemon.")
+    serve_parser.add_argument("path", help="O2O-dedicated path.")
+    serve_parser.add_argument("--temp-dir", default=None)
+    serve_parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+
+    submit_parser = commands.add_parser("submit", help="Send artist jobs to a running daemon.")
+    submit_parser.add_argument("artists", nargs="*")
+    submit_parser.add_argument("--file", help="File with one artist name per line.")
+    submit_parser.add_argument("--download", action="store_true", help="Download the results instead of only querying.")
+    submit_parser.add_argument("--max-results", type=int, default=None)
+    submit_parser.add_argument("--window", type=int, default=16, help="Most jobs to leave unread at once.")
+
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        serve(args.path, args.temp_dir, args.host, args.port, args.workers)
+    else:
+        artists = list(args.artists)
+        if args.file:
+            with open(args.file, 'r') as f:
+                artists.extend(line.strip() for line in f if line.strip())
+        options = {"max_results": args.max_results} if args.max_results else {}
+        try:
+            submit(artists, "download" if args.download else "query", args.host, args.port, options, args.window)
+        except urllib.error.URLError as e:
+            print(f"Could not reach the O2O daemon at {args.host}:{args.port}: {e}")
@@ -5,51 +5,165 @@ from googleapiclient.discovery import build
 import isodate
 from unidecode import unidecode
 import os
+import threading
+
+class QueryFilter:
+    """
+    Filter compiled once per query.
+
+    Candidates run through ordered stages, cheapest first: duration, banned substrings,
+    exact query match, then sentence similarity. Only candidates no earlier stage decided
+    reach `st_model`, and those are encoded in one batch by `select`.
+    `rejections` counts how many candidates each stage rejected.
+    """
+    def __init__(self, st_model, query, minimum_duration_seconds, maximum_duration_seconds, filtered_substrings, similarity_threshold=.3):
+        self.st_model = st_model
+        self.query = query.lower()
+        self.minimum_duration_seconds = minimum_duration_seconds
+        self.maximum_duration_seconds = maximum_duration_seconds
+        self.similarity_threshold = similarity_threshold
+
+        substrings = sorted({unidecode(i).lower() for i in filtered_substrings if i}, key=len, reverse=True)
+        self.substring_pattern = re.compile("|".join(map(re.escape, substrings))) if substrings else None
+
+        self._query_embedding = None
+        # The exact match stage only ever accepts, so it has no rejection count.
+        self.rejections = {"duration": 0, "substrings": 0, "similarity": 0}
+        self.accepted = {"exact_match": 0, "similarity": 0}
+
+    @property
+    def query_embedding(self):
+        if self._query_embedding is None:
+            self._query_embedding = self.st_model.encode([self.query], convert_to_tensor=True)
+        return self._query_embedding
+
+    def prefilter(self, title, channel, duration_seconds):
+        """
+        Runs the cheap stages. Returns True or False when they decide the candidate,
+        otherwise the normalized title and channel string to compare by similarity.
+        """
+        if duration_seconds is None or not self.minimum_duration_seconds < duration_seconds < self.maximum_duration_seconds:
+            self.rejections["duration"] += 1
+            return False
 
-def query_filter(st_model, query, title, channel, duration_seconds, minimum_duration_seconds, maximum_duration_seconds,filtered_substrings):
-
-    filtered_substrings = [i.lower() for i in filtered_substrings]
-
-    if not minimum_duration_seconds < duration_seconds < maximum_duration_seconds or any(sub in unidecode(title).lower() for sub in filtered_substrings):
-        return False
-    
-    title_channel_string = f"{title} {channel}"
+        if self.substring_pattern and self.substring_pattern.search(unidecode(title).lower()):
+            self.rejections["substrings"] += 1
+            return False
 
-    if query.lower() not in title_channel_string.lower():
-        emb_query = st_model.encode([query.lower()], convert_to_tensor=True)
-        emb_title = st_model.encode([unidecode(title_channel_string).lower()], convert_to_tensor=True)
-        sim_score = util.cos_sim(emb_query, emb_title).item()
+        title_channel_string = f"{title} {channel}"
+        if self.query in title_channel_string.lower():
+            self.accepted["exact_match"] += 1
+            return True
+
+        return unidecode(title_channel_string).lower()
+
+    def select(self, candidates):
+        """
+        Filters `candidates`, a list of (title, channel, duration_seconds) tuples.
+        Returns one boolean per candidate.
+        """
+        decisions = [self.prefilter(*candidate) for candidate in candidates]
+        ambiguous = [i for i, decision in enumerate(decisions) if isinstance(decision, str)]
+
+        if ambiguous:
+            emb_titles = self.st_model.encode([decisions[i] for i in ambiguous], convert_to_tensor=True)
+            sim_scores = util.cos_sim(self.query_embedding, emb_titles)[0].tolist()
+            for i, sim_score in zip(ambiguous, sim_scores):
+                decisions[i] = sim_score >= self.similarity_threshold
+                if decisions[i]:
+                    self.accepted["similarity"] += 1
+                else:
+                    self.rejections["similarity"] += 1
+
+        return decisions
+
+    def __call__(self, title, channel, duration_seconds):
+        return self.select([(title, channel, duration_seconds)])[0]
+
+    def stats(self):
+        return {"accepted": dict(self.accepted), "rejections": dict(self.rejections)}
+
+    def take(self, candidates, limit):
+        """
+        Returns the candidates accepted by `select`, stopping once `limit` are accepted.
+        Candidates are tuples that start with (title, channel, duration_seconds). They are checked in
+        chunks no larger than what is still needed, so nothing past the limit reaches the model or the counts.
+        """
+        accepted = []
+        index = 0
+        while index < len(candidates) and len(accepted) < limit:
+            chunk = candidates[index:index + limit - len(accepted)]
+            index += len(chunk)
+            decisions = self.select([candidate[:3] for candidate in chunk])
+            accepted.extend(candidate for candidate, keep in zip(chunk, decisions) if keep)
+        return accepted
+
+    def summary(self):
+        return format_filter_stats(self.stats())
+
+def format_filter_stats(stats):
+    """Formats the dict returned by `QueryFilter.stats` as one line."""
+    accepted, rejections = stats["accepted"], stats["rejections"]
+    rejected = ", ".join(f"{stage}: {count}" for stage, count in rejections.items())
+    return f"Accepted {sum(accepted.values())} (exact: {accepted['exact_match']}, similarity: {accepted['similarity']}); rejected by {rejected}"
 
-        if sim_score < .3:
-            return False
-        
-    return True
+def query_filter(st_model, query, title, channel, duration_seconds, minimum_duration_seconds, maximum_duration_seconds,filtered_substrings):
+    return QueryFilter(st_model, query, minimum_duration_seconds, maximum_duration_seconds, filtered_substrings)(title, channel, duration_seconds)
+
+_soundcloud_client_id = None
+_soundcloud_client_id_lock = threading.Lock()
+_youtube_clients = threading.local()
+
+def get_soundcloud_client_id(refresh=False):
+    """
+    Automatically fetches a working SoundCloud client_id.
+    The id is cached for the life of the process until `refresh` is passed.
+    """
+    global _soundcloud_client_id
+    with _soundcloud_client_id_lock:
+        if refresh or not _soundcloud_client_id:
+            _soundcloud_client_id = fetch_soundcloud_client_id()
+        return _soundcloud_client_id
+
+def fetch_soundcloud_client_id():
+    headers = {"User-Agent": "Mozilla/5.0"}
+    home_url = "https://soundcloud.com"
+
+    try:
+        html = requests.get(home_url, headers=headers, timeout=10).text
+        js_urls = re.findall(r'src="(https://a-v2\.sndcdn\.com/assets/[^"]+\.js)"', html)
+        if not js_urls:
+            print("⚠️ Could not find JS URL with client_id")
+            return None
 
-def query_soundcloud(st_model, query, minimum_duration_seconds, maximum_duration_seconds, filtered_substrings, max_results=400):
+        for js_url in js_urls:
+            js_code = requests.get(js_url, headers=headers, timeout=10).text
+            match = re.search(r'client_id\s*:\s*"([a-zA-Z0-9]{32})"', js_code)
+            if match:
+                return match.group(1)
+
+        print("⚠️ client_id not found in JS files")
+        return None
+    except Exception as e:
+        print(f"⚠️ Error fetching client_id: {e}")
+        return None
+
+def get_youtube_client(api_key):
+    """
+    Returns a YouTube Data API client, built once per thread and api_key.
+    Clients are not shared across threads because their HTTP transport is not thread-safe.
+    """
+    clients = getattr(_youtube_clients, "clients", None)
+    if clients is None:
+        clients = _youtube_clients.clients = {}
+    if api_key not in clients:
+        clients[api_key] = build("youtube", "v3", developerKey=api_key)
+    return clients[api_key]
+
+def query_soundcloud(st_model, query, minimum_duration_seconds, maximum_duration_seconds, filtered_substrings, max_results=400, compiled_filter=None):
     """Search SoundCloud for tracks matching a query."""
-    def get_soundcloud_client_id():
-        """Automatically fetches a working SoundCloud client_id."""
-        headers = {"User-Agent": "Mozilla/5.0"}
-        home_url = "https://soundcloud.com"
+    compiled_filter = compiled_filter or QueryFilter(st_model, query, minimum_duration_seconds, maximum_duration_seconds, filtered_substrings)
 
-        try:
-            html = requests.get(home_url, headers=headers, timeout=10).text
-            js_urls = re.findall(r'src="(https://a-v2\.sndcdn\.com/assets/[^"]+\.js)"', html)
-            if not js_urls:
-                print("⚠️ Could not find JS URL with client_id")
-                return None
-
-            for js_url in js_urls:
-                js_code = requests.get(js_url, headers=headers, timeout=10).text
-                match = re.search(r'client_id\s*:\s*"([a-zA-Z0-9]{32})"', js_code)
-                if match:
-                    return match.group(1)
-
-            print("⚠️ client_id not found in JS files")
-            return None
-        except Exception as e:
-            print(f"⚠️ Error fetching client_id: {e}")
-            return None
     client_id = get_soundcloud_client_id()
     if not client_id:
         print("❌ No client_id found — cannot query SoundCloud.")
@@ -60,6 +174,8 @@ def query_soundcloud(st_model, query, minimum_duration_seconds, maximum_duration
     limit = 50
     offset = 0
 
+    refreshed_client_id = False
+
     while len(all_tracks) < max_results:
         search_url = (
             f"https://api-v2.soundcloud.com/search/tracks"
@@ -68,6 +184,12 @@ def query_soundcloud(st_model, query, minimum_duration_seconds, maximum_duration
         )
 
         response = requests.get(search_url, headers=headers, timeout=10)
+        if response.status_code in (401, 403) and not refreshed_client_id:
+            # The cached client_id has expired, fetch a new one and retry the page once.
+            refreshed_client_id = True
+            client_id = get_soundcloud_client_id(refresh=True)
+            if client_id:
+                continue
         if response.status_code != 200:
             print(f"⚠️ SoundCloud returned {response.status_code}")
             break
@@ -77,6 +199,7 @@ def query_soundcloud(st_model, query, minimum_duration_seconds, maximum_duration
         if not collection:
             break
 
+        candidates = []
         for item in collection:
             title = item.get("title")
             duration_miliseconds = item.get("duration")
@@ -85,28 +208,26 @@ def query_soundcloud(st_model, query, minimum_duration_seconds, maximum_duration
             artist = publisher_metadata.get("artist") or item.get("user", {}).get("username")
             permalink_url = item.get("permalink_url")
             if title and permalink_url:
-                if query_filter(st_model=st_model,
-                                query=query,
-                                title=title,
-                                channel=artist,
-                                duration_seconds=duration_seconds,
-                                minimum_duration_seconds=minimum_duration_seconds,
-                                maximum_duration_seconds=maximum_duration_seconds,
-                                filtered_substrings=filtered_substrings):
-                    all_tracks.append({"title": title, 
-                                       "link": permalink_url,
-                                       "platform": "soundcloud"})
+                candidates.append((title, artist, duration_seconds, permalink_url))
+
+        for title, _, duration_seconds, permalink_url in compiled_filter.take(candidates, max_results - len(all_tracks)):
+            all_tracks.append({"title": title, 
+                               "link": permalink_url,
+                               "platform": "soundcloud",
+                               "duration_seconds": duration_seconds})
 
         print(f"Fetched {len(all_tracks)} tracks so far...")
         offset += limit
 
     return all_tracks[:max_results]
 
-def query_youtube(st_model, query, minimum_duration_seconds, maximum_duration_seconds, filtered_substrings, max_results=400,api_key=os.getenv("YOUTUBE_API_KEY")):
+def query_youtube(st_model, query, minimum_duration_seconds, maximum_duration_seconds, filtered_substrings, max_results=400,api_key=os.getenv("YOUTUBE_API_KEY"), compiled_filter=None):
     if not api_key:
         raise ValueError("Missing YouTube API key. Please set YOUTUBE_API_KEY as an environment variable.")
 
-    youtube = build("youtube", "v3", developerKey=api_key)
+    compiled_filter = compiled_filter or QueryFilter(st_model, query, minimum_duration_seconds, maximum_duration_seconds, filtered_substrings)
+
+    youtube = get_youtube_client(api_key)
 
     results = []
     request = youtube.search().list(
@@ -127,6 +248,7 @@ def query_youtube(st_model, query, minimum_duration_seconds, maximum_duration_se
         )
         video_response = video_request.execute()
 
+        candidates = []
         for item in video_response["items"]:
             title = item["snippet"]["title"]
             video_id = item["id"]
@@ -135,22 +257,18 @@ def query_youtube(st_model, query, minimum_duration_seconds, maximum_duration_se
             # Duration is in ISO 8601 format like 'PT4M13S'
             iso_duration = item["contentDetails"]["duration"]
             duration_seconds = isodate.parse_duration(iso_duration).total_seconds()
-            if query_filter(st_model=st_model,
-                            query=query,
-                            title=title, 
-                            channel=channel, 
-                            duration_seconds=duration_seconds, 
-                            minimum_duration_seconds=minimum_duration_seconds, 
-                            maximum_duration_seconds=maximum_duration_seconds,
-                            filtered_substrings=filtered_substrings):
-                results.append({
-                    "title": title,
-                    "link": link,
-                    "platform": "youtube"
-                })
-
-            if len(results) >= max_results:
-                return results[:max_results]
+            candidates.append((title, channel, duration_seconds, link))
+
+        for title, _, duration_seconds, link in compiled_filter.take(candidates, max_results - len(results)):
+            results.append({
+                "title": title,
+                "link": link,
+                "platform": "youtube",
+                "duration_seconds": duration_seconds
+            })
+
+        if len(results) >= max_results:
+            return results[:max_results]
 
         if "nextPageToken" in response and len(results) < max_results:
             request = youtube.search().list(
@@ -166,8 +284,12 @@ def query_youtube(st_model, query, minimum_duration_seconds, maximum_duration_se
 
     return results
 
-def query_media(st_model, platforms, query, max_results, minimum_duration_seconds, maximum_duration_seconds,filtered_substrings=[]):
-    """Query both SoundCloud and YouTube for tracks."""
+def query_media(st_model, platforms, query, max_results, minimum_duration_seconds, maximum_duration_seconds,filtered_substrings=[], filter_stats=None):
+    """
+    Query both SoundCloud and YouTube for tracks.
+    Pass a dict as `filter_stats` to get the filter's accepted and per-stage rejection counts back in it.
+    """
+    compiled_filter = QueryFilter(st_model, query, minimum_duration_seconds, maximum_duration_seconds, filtered_substrings)
     tracks = []
     if "soundcloud" in platforms:
         tracks.extend(query_soundcloud(st_model=st_model,
@@ -175,24 +297,31 @@ def query_media(st_model, platforms, query, max_results, minimum_duration_second
                                     max_results=max_results,
                                     filtered_substrings=filtered_substrings,
                                     minimum_duration_seconds=minimum_duration_seconds, 
-                                    maximum_duration_seconds=maximum_duration_seconds))
+                                    maximum_duration_seconds=maximum_duration_seconds,
+                                    compiled_filter=compiled_filter))
     if "youtube" in platforms:
         tracks.extend(query_youtube(st_model=st_model,
                                     query=query, 
                                     max_results=max_results, 
                                     filtered_substrings=filtered_substrings,
                                     minimum_duration_seconds=minimum_duration_seconds, 
-                                    maximum_duration_seconds=maximum_duration_seconds))
+                                    maximum_duration_seconds=maximum_duration_seconds,
+                                    compiled_filter=compiled_filter))
+    print(compiled_filter.summary())
+    if filter_stats is not None:
+        filter_stats.update(compiled_filter.stats())
     return tracks
 
-def query_artist(artist, st_model):
+def query_artist(artist, st_model, max_results=400, minimum_duration_seconds=60, maximum_duration_seconds=390,
+                 filtered_substrings=["beat", "slowed", "reverb", "free"], filter_stats=None):
     tracks = query_media(st_model=st_model,
                          platforms=["youtube","soundcloud"],
                          query=artist,
-                         max_results=400,
-                         minimum_duration_seconds=60,
-                         maximum_duration_seconds=390,
-                         filtered_substrings=["beat", "slowed", "reverb", "free"])
+                         max_results=max_results,
+                         minimum_duration_seconds=minimum_duration_seconds,
+                         maximum_duration_seconds=maximum_duration_seconds,
+                         filtered_substrings=filtered_substrings,
+                         filter_stats=filter_stats)
     
     for track in tracks:
         track["artist"] = artist
@@ -0,0 +1,206 @@
+import atexit
+import os
+import shutil
+import signal
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from uuid import uuid4
+
+STAGING_PREFIX = "o2o-staging-"
+TMPFS_ROOT = Path("/dev/shm")
+DEFAULT_BUDGET_BYTES = 1024 ** 3
+DEFAULT_TMPFS_HEADROOM_BYTES = 256 * 1024 ** 2
+DEFAULT_DISK_ROOT = Path.home() / ".cache" / "o2o"
+
+_signal_cleanup_installed = False
+
+
+def folder_size(folder):
+    total = 0
+    for root, _, files in os.walk(folder):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def is_tmpfs(path):
+    """Returns whether `path` lives on a RAM-backed filesystem, going by /proc/mounts."""
+    try:
+        with open("/proc/mounts", 'r') as f:
+            mounts = [line.split()[1:3] for line in f if len(line.split()) > 2]
+    except OSError:
+        return False
+
+    path = Path(path).resolve()
+    best_mount, best_type = "", ""
+    for mount_point, fs_type in mounts:
+        mount_point = mount_point.replace("\\040", " ")
+        if (path == Path(mount_point) or Path(mount_point) in path.parents) and len(mount_point) > len(best_mount):
+            best_mount, best_type = mount_point, fs_type
+    return best_type in ("tmpfs", "ramfs")
+
+
+def _pid_alive(pid):
+    if os.name == "nt":
+        # os.kill(pid, 0) terminates the process on Windows, so never sweep there.
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def sweep_stale(root):
+    """Removes staging folders left behind by O2O processes that are no longer running."""
+    root = Path(root)
+    if not root.is_dir():
+        return
+    for entry in root.glob(f"{STAGING_PREFIX}*"):
+        pid = entry.name[len(STAGING_PREFIX):].split("-", 1)[0]
+        if pid.isdigit() and int(pid) != os.getpid() and not _pid_alive(int(pid)):
+            shutil.rmtree(entry, ignore_errors=True)
+
+
+def _install_signal_cleanup():
+    """
+    Turns SIGTERM/SIGHUP into a normal interpreter exit so atexit cleanup runs.
+    Handlers that were already set by someone else are left alone.
+    """
+    global _signal_cleanup_installed
+    if _signal_cleanup_installed or threading.current_thread() is not threading.main_thread():
+        return
+
+    def handle(signum, frame):
+        raise SystemExit(128 + signum)
+
+    for name in ("SIGTERM", "SIGHUP"):
+        signum = getattr(signal, name, None)
+        if signum is not None and signal.getsignal(signum) == signal.SIG_DFL:
+            signal.signal(signum, handle)
+    _signal_cleanup_installed = True
+
+
+class StagingSlot:
+    """
+    A folder reserved for a single download.
+    """
+    def __init__(self, folder, reserved_bytes, on_tmpfs):
+        self.folder = Path(folder)
+        self.reserved_bytes = reserved_bytes
+        self.on_tmpfs = on_tmpfs
+
+    def size(self):
+        return folder_size(self.folder)
+
+
+class StagingManager:
+    """
+    Hands out space-budgeted temp folders for downloads.
+
+    `reserve` blocks while the staged bytes would exceed `budget_bytes`, places the
+    folder on tmpfs when it has room and spills to `disk_root` otherwise.
+    Everything staged by this process is removed on exit, and folders left by
+    crashed processes are swept on startup.
+    """
+    def __init__(self, budget_bytes=DEFAULT_BUDGET_BYTES, tmpfs_root=TMPFS_ROOT, disk_root=None,
+                 tmpfs_headroom_bytes=DEFAULT_TMPFS_HEADROOM_BYTES):
+        self.budget_bytes = budget_bytes
+        self.tmpfs_headroom_bytes = tmpfs_headroom_bytes
+        run_name = f"{STAGING_PREFIX}{os.getpid()}-{uuid4()}"
+
+        self.tmpfs_root = Path(tmpfs_root) if tmpfs_root and Path(tmpfs_root).is_dir() else None
+        self.disk_root = Path(disk_root) if disk_root else DEFAULT_DISK_ROOT
+        self.disk_root.mkdir(parents=True, exist_ok=True)
+        if is_tmpfs(self.disk_root):
+            print(f"⚠️ Staging spill directory {self.disk_root} is on tmpfs, so spilling will not free RAM.")
+        self.tmpfs_folder = self.tmpfs_root / run_name if self.tmpfs_root else None
+        self.disk_folder = self.disk_root / run_name
+
+        for root in (self.tmpfs_root, self.disk_root):
+            if root:
+                sweep_stale(root)
+
+        self._cond = threading.Condition()
+        self._slots = []
+
+        atexit.register(self.cleanup)
+        _install_signal_cleanup()
+
+    def _reserved_bytes(self):
+        return sum(slot.reserved_bytes for slot in self._slots)
+
+    def _pick_folder(self, estimate_bytes):
+        if self.tmpfs_folder:
+            # Space already promised to tmpfs slots that have not been written yet is not free.
+            outstanding = sum(max(slot.reserved_bytes - slot.size(), 0) for slot in self._slots if slot.on_tmpfs)
+            free = shutil.disk_usage(self.tmpfs_root).free - self.tmpfs_headroom_bytes - outstanding
+            if free >= estimate_bytes:
+                return self.tmpfs_folder, True
+        return self.disk_folder, False
+
+    def acquire(self, estimate_bytes):
+        """
+        Waits for `estimate_bytes` of budget and returns a fresh `StagingSlot`.
+        A single reservation larger than the whole budget is let through when nothing else is staged.
+        """
+        with self._cond:
+            while self._slots and self._reserved_bytes() + estimate_bytes > self.budget_bytes:
+                self._cond.wait()
+            parent, on_tmpfs = self._pick_folder(estimate_bytes)
+            folder = parent / str(uuid4())
+            folder.mkdir(parents=True, exist_ok=True)
+            slot = StagingSlot(folder, estimate_bytes, on_tmpfs)
+            self._slots.append(slot)
+            return slot
+
+    def settle(self, slot):
+        """Grows the reservation of `slot` to what it actually holds on disk."""
+        size = slot.size()
+        with self._cond:
+            slot.reserved_bytes = max(slot.reserved_bytes, size)
+        return size
+
+    def release(self, slot):
+        shutil.rmtree(slot.folder, ignore_errors=True)
+        with self._cond:
+            if slot in self._slots:
+                self._slots.remove(slot)
+            self._cond.notify_all()
+
+    @contextmanager
+    def reserve(self, estimate_bytes):
+        slot = self.acquire(estimate_bytes)
+        try:
+            yield slot
+        finally:
+            self.release(slot)
+
+    def usage(self):
+        with self._cond:
+            slots = list(self._slots)
+            reserved = self._reserved_bytes()
+        tmpfs_bytes = sum(slot.size() for slot in slots if slot.on_tmpfs)
+        disk_bytes = sum(slot.size() for slot in slots if not slot.on_tmpfs)
+        return {
+            "budget_bytes": self.budget_bytes,
+            "reserved_bytes": reserved,
+            "used_bytes": tmpfs_bytes + disk_bytes,
+            "tmpfs_bytes": tmpfs_bytes,
+            "disk_bytes": disk_bytes,
+            "active_downloads": len(slots)
+        }
+
+    def cleanup(self):
+        for folder in (self.tmpfs_folder, self.disk_folder):
+            if folder:
+                shutil.rmtree(folder, ignore_errors=True)
+        with self._cond:
+            self._slots.clear()
+            self._cond.notify_all()